@@ -11,6 +11,9 @@ import requests
 # Characters that have syntactic meaning in RMA filter expressions
 _RMA_UNSAFE = re.compile(r"['\[\],]")
 
+# ", layer 2/3 ..." tail of a layer-specific structure name
+_LAYER_SUFFIX = re.compile(r",?\s*layer\s+[\w/]+.*", re.IGNORECASE)
+
 _API_BASE         = "http://api.brain-map.org"
 _RMA_URL          = "http://api.brain-map.org/api/v2/data/query.json"
 _DOWNLOAD_URL     = "http://api.brain-map.org/api/v2/well_known_file_download"
@@ -82,7 +85,7 @@ def fetch_species_options(species: str) -> dict:
         line       = (r.get("line_name")                 or "").strip()
 
         if name and "layer" in name.lower():
-            parent_name = re.sub(r",?\s*layer\s+[\w/]+.*", "", name, flags=re.IGNORECASE).strip()
+            parent_name = _LAYER_SUFFIX.sub("", name).strip()
             use_acr   = parent_acr or acr
             use_name  = parent_name or name
             is_parent = bool(parent_acr)
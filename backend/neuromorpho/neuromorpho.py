@@ -4,50 +4,130 @@
 # Handles all outbound HTTP requests to the NeuroMorpho API.
 # Selects primary or fallback base URL on startup.
 ##############################################
+import contextlib
 import datetime
+import functools
+import logging
+import os
 import re
+import tempfile
+import threading
+import time
 import requests
-from dataclasses import dataclass, field
-from typing import Any, Dict, List, Optional, Tuple
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
 
 _PRIMARY_URL = "http://cngpro.gmu.edu:8080/api"
 _FALLBACK_URL = "https://neuromorpho.org/api"
+USER_AGENT = "www.mooseneuro.org/1.0 (contact: mooseneuro@gmail.com)"
+
+# Max parallel requests a single fan-out issues; species metadata selects
+# are also capped at this process-wide (see _AdmissionController).
+# Override with NEUROMORPHO_CONCURRENCY.
+CONCURRENCY = max(1, int(os.environ.get("NEUROMORPHO_CONCURRENCY", "8")))
+
+# One shared session so repeated calls reuse keep-alive connections
+# instead of paying a TCP (and TLS) handshake per request. The per-host
+# pool keeps room for a few concurrent fan-outs plus ordinary route
+# traffic; beyond it urllib3 would open and then discard extra sockets.
+_SESSION = requests.Session()
+_SESSION.headers.update({"User-Agent": USER_AGENT})
+_ADAPTER = HTTPAdapter(pool_maxsize=max(32, 4 * CONCURRENCY))
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+
+
+class _AdmissionController:
+    """Caps in-flight species selects (metadata probes, pages and counts).
+
+    The cap starts at CONCURRENCY, halves whenever upstream throttles or
+    fails (429, 5xx, timeout), and grows back by one after a run of
+    successes as long as the current cap. A Condition rather than a
+    Semaphore, because the limit changes while callers are waiting.
+    """
+
+    def __init__(self, limit: int):
+        self._max = limit
+        self._limit = limit
+        self._active = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self._cond:
+            while self._active >= self._limit:
+                self._cond.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify()
+
+    def backoff(self) -> None:
+        with self._cond:
+            self._limit = max(1, self._limit // 2)
+            self._successes = 0
+
+    def success(self) -> None:
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self._limit and self._limit < self._max:
+                self._limit += 1
+                self._successes = 0
+                self._cond.notify()
+
+
+_ADMISSION = _AdmissionController(CONCURRENCY)
+
 
 def _get_base_url() -> str:
     try:
-        requests.get(f"{_PRIMARY_URL}/neuron/fields/species", timeout=5)
+        _SESSION.get(f"{_PRIMARY_URL}/neuron/fields/species", timeout=5)
         return _PRIMARY_URL
     except Exception:
         return _FALLBACK_URL
 
 
 BASE_URL = _get_base_url()
-USER_AGENT = "www.mooseneuro.org/1.0 (contact: mooseneuro@gmail.com)"
-_HEADERS = {"User-Agent": USER_AGENT}
+_SELECT_URL = f"{BASE_URL}/neuron/select"
 
 
 # ---------------------------------------------------------------------------
-# Data container
+# API calls
 # ---------------------------------------------------------------------------
 
-@dataclass
-class NeuronSWCData:
-    neuron_id: int
-    neuron_name: str
-    archive_name: str
-    swc_content: str
-    api_data: Dict[str, Any] = field(default_factory=dict)
+_SPECIES_TTL = 3600  # seconds; the species list changes only with new archives
+_species_cache: Optional[Tuple[float, List[str]]] = None  # (expires_at, species)
+_species_lock = threading.Lock()
 
 
-# ---------------------------------------------------------------------------
-# API calls
-# ---------------------------------------------------------------------------
-
 def fetch_species() -> List[str]:
-    """Return a sorted list of all species available on NeuroMorpho."""
-    resp = requests.get(f"{BASE_URL}/neuron/fields/species", headers=_HEADERS, timeout=30)
-    resp.raise_for_status()
-    return sorted(resp.json()["fields"])
+    """Return a sorted list of all species available on NeuroMorpho.
+
+    Cached in-process for _SPECIES_TTL seconds so the species dropdown
+    doesn't cost an upstream round-trip on every page load. Concurrent
+    misses share one upstream request.
+    """
+    global _species_cache
+    cached = _species_cache
+    if cached and time.monotonic() < cached[0]:
+        return list(cached[1])
+    with _species_lock:
+        cached = _species_cache
+        if cached and time.monotonic() < cached[0]:
+            return list(cached[1])
+        resp = _SESSION.get(f"{BASE_URL}/neuron/fields/species", timeout=30)
+        resp.raise_for_status()
+        species = sorted(resp.json()["fields"])
+        _species_cache = (time.monotonic() + _SPECIES_TTL, species)
+    return list(species)
 
 
 def search_neurons(
@@ -74,8 +154,12 @@ def search_neurons(
     if archive:
         body["archive"] = [archive]
 
-    url = f"{BASE_URL}/neuron/select?page={page}&size={size}"
-    resp = requests.post(url, json=body, headers=_HEADERS, timeout=30)
+    resp = _SESSION.post(
+        _SELECT_URL,
+        params={"page": page, "size": size},
+        json=body,
+        timeout=30,
+    )
 
     # NeuroMorpho returns 404 when query has no results — treat as empty, not error
     if resp.status_code == 404:
@@ -85,64 +169,160 @@ def search_neurons(
     return resp.json()
 
 
-def fetch_neuron_metadata(species: str) -> Dict:
+# Largest page the API serves; metadata paging uses it to minimise round trips.
+_METADATA_PAGE_SIZE = 500
+
+
+def fetch_neuron_metadata(species: str) -> Tuple[Dict, bool]:
     """
     Collect all brain regions, cell types, and archives for a species.
 
-    This fetches every page sequentially — it's the slow call (~5-20s for
-    large species). Cache the result on disk; see neuromorpho_routes.py.
+    This pages through every neuron of the species — it's the slow call
+    (~5-20s for large species). Pages after the first are fetched
+    CONCURRENCY at a time and folded in as each one arrives, so no more
+    than a few pages are held in memory at once.
+
+    Returns (metadata, complete). A page that fails is logged and
+    skipped, and complete is False; callers must not cache such a
+    result as if it were whole. See neuromorpho_routes.py.
     """
-    # Get total page count using the same page size as the loop below.
-    # Without size=500 the API returns totalPages based on ~20 items/page,
-    # but the loop fetches 500/page — so page counts differ and 404s appear.
-    first = requests.post(
-        f"{BASE_URL}/neuron/select?page=0&size=500",
-        json={"species": [species]},
-        headers=_HEADERS,
-        timeout=30,
-    )
+    # Get total page count using the same page size as the fan-out below.
+    # Without an explicit size the API returns totalPages based on ~20
+    # items/page, but the fan-out fetches 500/page — so page counts differ
+    # and 404s appear.
+    first = _admitted_select(species, 0, _METADATA_PAGE_SIZE, timeout=30)
     first.raise_for_status()
     first_data = first.json()
-    total_pages = first_data.get("page", {}).get("totalPages", 1)
+    page_info = first_data.get("page", {})
+    total_pages = page_info.get("totalPages", 1)
+    total_elements = page_info.get("totalElements")
 
     brain_regions: set = set()
     cell_types: set = set()
     archives: set = set()
 
-    for page in range(total_pages):
-        try:
-            if page == 0:
-                data = first_data
-            else:
-                r = requests.post(
-                    f"{BASE_URL}/neuron/select?page={page}&size=500",
-                    json={"species": [species]},
-                    headers=_HEADERS,
-                    timeout=40,
-                )
-                if r.status_code == 404:
-                    break
-                r.raise_for_status()
-                data = r.json()
-            neurons = data.get("_embedded", {}).get("neuronResources", [])
-            for n in neurons:
-                _collect(brain_regions, n.get("brain_region"))
-                _collect(cell_types, n.get("cell_type"))
-                _collect(archives, n.get("archive"))
-        except Exception as e:
-            print(f"[neuromorpho] page {page} failed: {e}")
+    complete = True
+
+    def _fold(page_values: Tuple[set, set, set]) -> None:
+        brain_regions.update(page_values[0])
+        cell_types.update(page_values[1])
+        archives.update(page_values[2])
+
+    try:
+        _fold(_extract_page(first_data.get("_embedded", {}).get("neuronResources", [])))
+    except Exception as e:
+        complete = False
+        log.warning("metadata page 0 for %s failed: %s", species, e)
+    del first_data
+
+    if total_pages > 1:
+        with ThreadPoolExecutor(max_workers=min(CONCURRENCY, total_pages - 1)) as pool:
+            futures = {
+                pool.submit(_fetch_metadata_page, species, page): page
+                for page in range(1, total_pages)
+            }
+            for future in as_completed(futures):
+                try:
+                    _fold(future.result())
+                except Exception as e:
+                    complete = False
+                    log.warning("metadata page %d for %s failed: %s", futures[future], species, e)
 
     return {
         "species": [species],
         "brain_region": sorted(str(v) for v in brain_regions),
         "cell_type": sorted(str(v) for v in cell_types),
         "archive": sorted(str(v) for v in archives),
-    }
+        # Only a complete result may be revalidated by count alone.
+        "total_elements": total_elements if complete else None,
+    }, complete
+
+
+def count_species_neurons(species: str) -> Optional[int]:
+    """Return how many neurons the archive holds for a species.
+
+    One single-record request; lets a cache refresh skip the full
+    fetch_neuron_metadata fan-out when the count hasn't changed.
+    """
+    r = _admitted_select(species, 0, 1, timeout=30)
+    if r.status_code == 404:
+        return 0
+    r.raise_for_status()
+    return r.json().get("page", {}).get("totalElements")
+
+
+def _fetch_metadata_page(species: str, page: int) -> Tuple[set, set, set]:
+    """Fetch one 500-per-page metadata page and keep only the three fields
+    aggregated above. The decoded page itself is dropped before returning,
+    so completed futures hold a few short strings, not 500 neuron records.
+    Raises if the page still fails after retries.
+    """
+    r = _admitted_select(species, page, _METADATA_PAGE_SIZE, timeout=40)
+    if r.status_code == 404:
+        return set(), set(), set()
+    r.raise_for_status()
+    return _extract_page(r.json().get("_embedded", {}).get("neuronResources", []))
+
+
+# Extra attempts for a throttled (429), failed (5xx) or timed-out species
+# select before giving up; each waits _RETRY_DELAY * 2**attempt seconds.
+_SELECT_RETRIES = 3
+_RETRY_DELAY = 0.5
+
+
+def _admitted_select(species: str, page: int, size: int, timeout: float) -> requests.Response:
+    """POST one species page of /neuron/select under _ADMISSION.
+
+    Throttling, 5xx and timeouts halve the admission cap and the request
+    is retried under the lowered cap; the last attempt's response (or
+    Timeout) is returned (or raised) to the caller. A request halves the
+    cap only on its first failure, so one slow select retrying doesn't
+    drive the cap to 1 by itself.
+    """
+    for attempt in range(_SELECT_RETRIES + 1):
+        last = attempt == _SELECT_RETRIES
+        with _ADMISSION.slot():
+            try:
+                r = _SESSION.post(
+                    _SELECT_URL,
+                    params={"page": page, "size": size},
+                    json={"species": [species]},
+                    timeout=timeout,
+                )
+            except requests.Timeout:
+                if attempt == 0:
+                    _ADMISSION.backoff()
+                if last:
+                    raise
+                r = None
+        if r is not None:
+            if r.status_code != 429 and r.status_code < 500:
+                _ADMISSION.success()
+                return r
+            if attempt == 0:
+                _ADMISSION.backoff()
+            if last:
+                return r
+        time.sleep(_RETRY_DELAY * 2 ** attempt)
+
+
+def _extract_page(neurons: List[Dict]) -> Tuple[set, set, set]:
+    """Return the (brain_region, cell_type, archive) values on one page."""
+    return (
+        _field_values(neurons, "brain_region"),
+        _field_values(neurons, "cell_type"),
+        _field_values(neurons, "archive"),
+    )
 
 
+@functools.lru_cache(maxsize=512)
 def fetch_neuron_by_id(neuron_id: int) -> Dict:
-    """Return the raw neuron record for a single neuron ID."""
-    resp = requests.get(f"{BASE_URL}/neuron/id/{neuron_id}", headers=_HEADERS, timeout=30)
+    """Return the raw neuron record for a single neuron ID.
+
+    Records are immutable upstream, so successful lookups are memoized;
+    callers must treat the returned dict as read-only.
+    """
+    resp = _SESSION.get(f"{BASE_URL}/neuron/id/{neuron_id}", timeout=30)
     resp.raise_for_status()
     return resp.json()
 
@@ -192,10 +372,9 @@ def fetch_archive_pmids(archive: str) -> List[str]:
 def fetch_literature_by_pmid(pmid: str) -> Optional[Dict]:
     """Fetch paper metadata from NeuroMorpho literature API by PMID."""
     try:
-        resp = requests.get(
+        resp = _SESSION.get(
             f"{BASE_URL}/literature/select",
             params={"q": f"pmid:{pmid}", "size": 1},
-            headers=_HEADERS,
             timeout=10,
         )
         resp.raise_for_status()
@@ -218,8 +397,11 @@ def _format_ref_text(lit: Dict) -> str:
     return " ".join(parts)
 
 
+_HTML_TAG = re.compile(r"<[^>]+>")
+
+
 def _strip_html(text: str) -> str:
-    return re.sub(r"<[^>]+>", "", text).strip()
+    return _HTML_TAG.sub("", text).strip()
 
 
 def neuron_to_details(neuron: Dict) -> Dict:
@@ -245,11 +427,18 @@ def neuron_to_details(neuron: Dict) -> Dict:
     pmids = [str(p) for p in (neuron.get('reference_pmid') or [])]
     dois  = neuron.get('reference_doi') or []
 
+    # Each reference is a separate literature lookup; issue them together
+    # rather than paying one round-trip per reference in series.
+    if len(pmids) > 1:
+        with ThreadPoolExecutor(max_workers=min(CONCURRENCY, len(pmids))) as pool:
+            lits = list(pool.map(fetch_literature_by_pmid, pmids))
+    else:
+        lits = [fetch_literature_by_pmid(p) for p in pmids]
+
     refs = []
-    for i, pmid in enumerate(pmids):
+    for i, (pmid, lit) in enumerate(zip(pmids, lits)):
         doi  = dois[i] if i < len(dois) else None
         ref: Dict = {'pmid': pmid}
-        lit = fetch_literature_by_pmid(pmid)
         if lit:
             ref['text'] = _format_ref_text(lit)
             doi = doi or lit.get('doi')
@@ -270,32 +459,54 @@ def neuron_to_details(neuron: Dict) -> Dict:
     return detail
 
 
-def fetch_swc_direct(archive: str, name: str, neuron_id: int) -> Tuple[List["NeuronSWCData"], List[Dict]]:
-    """
-    Download a single SWC file when archive and neuron_name are already known.
-    Skips the /neuron/id/{nid} metadata lookup — one fewer HTTP round-trip.
+def write_atomic(dest: str, chunks: Iterable[bytes]) -> None:
+    """Write chunks to dest so readers never see a partial file.
+
+    The chunks go to a uniquely named temp file beside dest, which is
+    synced and renamed into place once complete, and removed on any
+    failure. Concurrent writers to the same dest don't collide; the last
+    rename wins.
     """
+    tmp = None
     try:
-        swc = requests.get(f"https://neuromorpho.org/dableFiles/{archive.lower()}/CNG version/{name}.CNG.swc", headers=_HEADERS, timeout=40)
-        if swc.status_code != 200:
-            return [], [{"neuron_id": neuron_id, "error": f"SWC download failed: HTTP {swc.status_code}"}]
-        return [NeuronSWCData(
-            neuron_id=neuron_id,
-            neuron_name=name,
-            archive_name=archive.lower(),
-            swc_content=swc.text,
-            api_data={},
-        )], []
-    except Exception as e:
-        return [], [{"neuron_id": neuron_id, "error": str(e)}]
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(dest), suffix=".part", delete=False
+        ) as f:
+            tmp = f.name
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, dest)
+    except BaseException:
+        if tmp is not None:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+        raise
+
+
+def download_swc(archive: str, name: str, dest: str) -> None:
+    """Stream a neuron's SWC file to dest in 64 KiB chunks without holding
+    it in memory. Written through write_atomic, so dest never exists
+    half-written. Raises on HTTP or I/O errors.
+    """
+    with _SESSION.get(_swc_url(archive, name), timeout=40, stream=True) as resp:
+        if resp.status_code != 200:
+            raise RuntimeError(f"SWC download failed: HTTP {resp.status_code}")
+        write_atomic(dest, resp.iter_content(chunk_size=65536))
 
 
 # ---------------------------------------------------------------------------
 # Internal
 # ---------------------------------------------------------------------------
 
-def _collect(target: set, value) -> None:
-    if isinstance(value, list):
-        target.update(v for v in value if v)
-    elif value:
-        target.add(value)
+def _swc_url(archive: str, name: str) -> str:
+    return f"https://neuromorpho.org/dableFiles/{archive.lower()}/CNG version/{name}.CNG.swc"
+
+
+def _field_values(neurons: List[Dict], key: str) -> set:
+    """Non-empty values of key across neurons; list-valued fields are flattened."""
+    values = (n.get(key) for n in neurons)
+    return set(filter(None, chain.from_iterable(
+        v if isinstance(v, list) else (v,) for v in values
+    )))
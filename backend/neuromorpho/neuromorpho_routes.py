@@ -1,29 +1,181 @@
 ##############################################
 # neuromorpho_routes.py — Flask routes for NeuroMorpho.org
 ##############################################
+import contextlib
+import functools
 import json
+import logging
+import threading
+import time
 import traceback
 from pathlib import Path
+from typing import NamedTuple
 
 from flask import Blueprint, jsonify, request
 
 from .neuromorpho import (
+    count_species_neurons,
+    download_swc,
     fetch_species,
     fetch_neuron_metadata,
     fetch_neuron_by_id,
-    fetch_swc_direct,
     search_neurons,
+    write_atomic,
 )
 
+log = logging.getLogger(__name__)
+
 neuromorpho_routes = Blueprint("neuromorpho", __name__)
 
 # Cache directory for species metadata (shared across sessions)
 _CACHE_DIR = Path("data") / "neuromorpho"
-_CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
 USER_UPLOADS_DIR = Path(__file__).resolve().parent.parent / "user_uploads"
 
 
+@functools.lru_cache(maxsize=256)
+def _cache_path(species: str) -> Path:
+    """Cache file for a species, e.g. "Rat " -> data/neuromorpho/rat.json."""
+    safe_name = species.strip().lower().replace(" ", "_")
+    return _CACHE_DIR / f"{safe_name}.json"
+
+
+def _load_cache(cache_file: Path) -> dict:
+    """Parse a cached metadata file. Raises if missing or corrupt."""
+    return json.loads(cache_file.read_bytes())
+
+
+def _ensure_cache_dir() -> None:
+    """Create the cache directory at write time rather than at import, so
+    a directory removed while the server runs is recreated."""
+    _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+
+# Species metadata served from memory for _METADATA_TTL seconds; the file
+# above only warms this after a restart. Misses are serialized per species
+# so concurrent requests for an unseen species share one fan-out.
+_METADATA_TTL = 24 * 3600
+# A fetch that lost pages is served from memory only briefly, then retried.
+_PARTIAL_METADATA_TTL = 300
+# An expired entry whose neuron count is unchanged is kept without a full
+# refetch at most this many times in a row; edits that leave the count
+# alone (reclassified neurons) are picked up by the forced refetch.
+_MAX_COUNT_REVALIDATIONS = 6
+
+
+class _CacheEntry(NamedTuple):
+    expires_at: float  # time.monotonic() deadline
+    metadata: dict
+    complete: bool  # False if some metadata pages failed
+    revalidations: int  # count-only revalidations since the last full fetch
+
+
+_metadata_cache: dict = {}  # species key -> _CacheEntry
+_species_locks: dict = {}  # species key -> [lock, holders + waiters]
+_species_locks_guard = threading.Lock()
+
+
+@contextlib.contextmanager
+def _species_lock(key: str):
+    """Hold the per-species fetch lock. Entries exist only while someone
+    holds or waits on them, so arbitrary species strings don't pile up."""
+    with _species_locks_guard:
+        entry = _species_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _species_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _species_locks[key]
+
+
+def _save_cache(cache_file: Path, data: dict) -> None:
+    """Write atomically so readers never see a partial cache."""
+    _ensure_cache_dir()
+    # Machine-read only, so skip pretty-printing.
+    write_atomic(str(cache_file), [json.dumps(data, separators=(",", ":")).encode("utf-8")])
+
+
+def _get_metadata(cache_file: Path, species: str) -> dict:
+    """Return species metadata from memory, the disk cache, or upstream."""
+    key = cache_file.stem
+    cached = _metadata_cache.get(key)
+    if cached and time.monotonic() < cached.expires_at:
+        return cached.metadata
+
+    with _species_lock(key):
+        # Another request may have filled the cache while we waited.
+        cached = _metadata_cache.get(key)
+        if cached and time.monotonic() < cached.expires_at:
+            return cached.metadata
+
+        result = None
+        ttl = _METADATA_TTL
+        # Entry to fall back on when upstream fails: the expired one in
+        # memory, or on a cold start an expired file from disk.
+        fallback = cached
+        if cached is None:
+            # Cold start: the file was written when it was fetched, so its
+            # mtime dates it. It is only fresh until it is one TTL old.
+            try:
+                age = max(0.0, time.time() - cache_file.stat().st_mtime)
+                disk = _load_cache(cache_file)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                cache_file.unlink(missing_ok=True)
+            else:
+                if age < _METADATA_TTL:
+                    result, ttl = disk, _METADATA_TTL - age
+                else:
+                    fallback = _CacheEntry(0.0, disk, True, 0)
+
+        revalidations = 0
+        if (result is None and cached is not None and cached.complete
+                and cached.metadata.get("total_elements") is not None
+                and cached.revalidations < _MAX_COUNT_REVALIDATIONS):
+            # Expired: an unchanged neuron count means nothing was added or
+            # removed, so one cheap request can stand in for the fan-out.
+            try:
+                if count_species_neurons(species) == cached.metadata["total_elements"]:
+                    result = cached.metadata
+                    revalidations = cached.revalidations + 1
+            except Exception:
+                pass
+
+        complete = True
+        if result is None:
+            try:
+                result, complete = fetch_neuron_metadata(species)
+            except Exception:
+                if fallback is None:
+                    raise
+                # Upstream down: serve stale data briefly, then try again.
+                _, result, complete, revalidations = fallback
+                ttl = _PARTIAL_METADATA_TTL
+            else:
+                if complete:
+                    # The disk copy only warms a restart; failing to write
+                    # it must not cost the caller the fetched result.
+                    try:
+                        _save_cache(cache_file, result)
+                    except OSError:
+                        log.exception("could not write metadata cache %s", cache_file)
+                else:
+                    # Partial results are never persisted and only held
+                    # briefly, so the species is refetched soon. Until
+                    # then, a previous complete result beats a fresh
+                    # partial one.
+                    ttl = _PARTIAL_METADATA_TTL
+                    if fallback is not None and fallback.complete:
+                        _, result, complete, revalidations = fallback
+        _metadata_cache[key] = _CacheEntry(time.monotonic() + ttl, result, complete, revalidations)
+        return result
+
+
 # ---------------------------------------------------------------------------
 # Routes
 # ---------------------------------------------------------------------------
@@ -42,24 +194,18 @@ def get_metadata():
     """
     GET /neuromorpho/metadata?species=rat
     Returns brain regions, cell types, archives for the species.
-    Result is cached in data/neuromorpho/<safe_name>.json.
+    Result is cached in memory and in data/neuromorpho/<safe_name>.json.
     """
     species = request.args.get("species")
     if not species:
         return jsonify({"error": "species query param required"}), 400
 
-    safe_name = species.strip().lower().replace(" ", "_")
-    cache_file = _CACHE_DIR / f"{safe_name}.json"
-    if cache_file.exists():
-        try:
-            return jsonify(json.loads(cache_file.read_text()))
-        except Exception:
-            cache_file.unlink(missing_ok=True)
-
+    cache_file = _cache_path(species)
     try:
-        result = fetch_neuron_metadata(species)
-        cache_file.write_text(json.dumps(result, indent=2))
-        return jsonify(result)
+        metadata = _get_metadata(cache_file, species)
+        # total_elements only feeds count revalidation; it isn't part of
+        # the response.
+        return jsonify({k: v for k, v in metadata.items() if k != "total_elements"})
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
@@ -108,24 +254,25 @@ def search():
     })
 
 
-def stage_neuron(neuron_id: int, client_id: str) -> dict:
+def stage_neuron(neuron_id: int, client_id: str, refresh: bool = False) -> dict:
     """Download SWC for neuron_id and save to the user's session directory.
-    Returns {"filename": "<name>.swc"}. Raises on failure."""
+    Returns {"filename": "<name>.swc"}. Raises on failure.
+
+    If the file is already staged for this client the download is skipped;
+    pass refresh=True to fetch it again."""
     rec = fetch_neuron_by_id(neuron_id)
     archive = rec.get("archive", "")
     name = rec.get("neuron_name", "")
     if not archive or not name:
         raise ValueError(f"Missing archive or neuron_name for neuron {neuron_id}")
 
-    successes, failures = fetch_swc_direct(archive, name, neuron_id)
-    if not successes:
-        raise RuntimeError(f"SWC download failed: {failures}")
-
-    swc = successes[0]
-    filename = f"{swc.neuron_name}.swc"
+    filename = f"{name}.swc"
     dest_dir = USER_UPLOADS_DIR / client_id
+    if not refresh and (dest_dir / filename).is_file():
+        return {"filename": filename}
+
     dest_dir.mkdir(parents=True, exist_ok=True)
-    (dest_dir / filename).write_text(swc.swc_content, encoding="utf-8")
+    download_swc(archive, name, str(dest_dir / filename))
     return {"filename": filename}
 
 
@@ -3,6 +3,7 @@ monkey.patch_all()
 
 import os
 import sys
+import logging
 import subprocess
 import json
 import uuid
@@ -11,12 +12,15 @@ import threading
 import shutil
 import zipfile
 import re
+import mmap
 import secrets
 from flask import Flask, request, jsonify, send_from_directory, send_file, after_this_request
 from flask_cors import CORS
 from flask_socketio import SocketIO, join_room, leave_room, emit as sock_emit
 from werkzeug.utils import secure_filename
 
+log = logging.getLogger(__name__)
+
 # --- Configuration ---
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 USER_UPLOADS_DIR = os.path.join(BASE_DIR, 'user_uploads')
@@ -144,17 +148,23 @@ def _validate_config_sources(config_data):
 
     return violations
 
+_MODEL_FILENAME_RE = re.compile(r'^jardes_model_(\d+)\.json$')
+_JSON_INDEX_RE = re.compile(r'(\d+)\.json$')
+_UNSAFE_BASENAME_RE = re.compile(r'[^\w\-. ]')
+
 def get_next_model_filename(directory):
-    pattern = re.compile(r'^jardes_model_(\d+)\.json$')
     max_n = 0
-    if os.path.exists(directory):
-        for filename in os.listdir(directory):
-            match = pattern.match(filename)
-            if match:
-                try:
-                    n = int(match.group(1))
-                    if n > max_n: max_n = n
-                except ValueError: continue
+    try:
+        filenames = os.listdir(directory)
+    except FileNotFoundError:
+        filenames = []
+    for filename in filenames:
+        match = _MODEL_FILENAME_RE.match(filename)
+        if match:
+            try:
+                n = int(match.group(1))
+                if n > max_n: max_n = n
+            except ValueError: continue
     return f"jardes_model_{max_n + 1}.json"
 
 # --- API Endpoints ---
@@ -221,37 +231,61 @@ PROTO_REGISTRY_DIR = os.path.join(BASE_DIR, 'proto_registry')
 _ALLOWED_STAGING_DIRS = {'CELL_MODELS', 'CHEM_MODELS', 'CHAN_MODELS'}
 
 
-_NM_ITEM_CACHE = os.path.join(BASE_DIR, 'data', 'neuromorpho', 'item_cache.json')
-
-def _nm_cache_load():
-    if os.path.exists(_NM_ITEM_CACHE):
-        try:
-            return json.loads(open(_NM_ITEM_CACHE).read())
-        except Exception:
-            return {}
-    return {}
-
-def _nm_cache_save(cache):
-    os.makedirs(os.path.dirname(_NM_ITEM_CACHE), exist_ok=True)
-    with open(_NM_ITEM_CACHE, 'w') as f:
-        json.dump(cache, f, indent=2)
-
+_registry_cache = {}   # proto_type → ((st_mtime_ns, st_size), parsed registry, {id: item})
 
 def _load_registry(proto_type):
+    """Return (version key, parsed registry, {id: item}) or None if the file
+    is missing, re-reading it only when the file changes.
+    Callers must treat the returned data as read-only."""
     path = os.path.join(PROTO_REGISTRY_DIR, f'{proto_type}_protos.json')
-    if not os.path.exists(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        _registry_cache.pop(proto_type, None)
         return None
-    with open(path, 'r') as f:
-        return json.load(f)
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _registry_cache.get(proto_type)
+    if cached and cached[0] == key:
+        return cached
+    with open(path, 'rb') as f:
+        data = json.loads(f.read())
+    index = {}
+    for item in data.get('items', []):
+        index.setdefault(item.get('id'), item)
+    entry = (key, data, index)
+    _registry_cache[proto_type] = entry
+    return entry
+
+_registry_json_cache = {}   # proto_type → ((st_mtime_ns, st_size), encoded registry)
+
+def _registry_response(proto_type, entry):
+    """Serve a registry entry from _load_registry, encoding it once per file version."""
+    key, data, _ = entry
+    cached = _registry_json_cache.get(proto_type)
+    if not cached or cached[0] != key:
+        body = f"{app.json.dumps(data)}\n".encode('utf-8')
+        cached = (key, body)
+        _registry_json_cache[proto_type] = cached
+    return app.response_class(cached[1], mimetype='application/json')
+
+def _find_registry_item(proto_id):
+    """Return the first registry item with this id across all proto types, or None."""
+    for proto_type in ('morpho', 'chan', 'chem'):
+        entry = _load_registry(proto_type)
+        if entry is not None:
+            item = entry[2].get(proto_id)
+            if item is not None:
+                return item
+    return None
 
 @app.route('/proto_digest/<proto_type>', methods=['GET'])
 def get_proto_digest(proto_type):
     if proto_type not in ('morpho', 'chan', 'chem'):
         return jsonify({'error': 'Invalid type'}), 400
-    data = _load_registry(proto_type)
-    if data is None:
+    entry = _load_registry(proto_type)
+    if entry is None:
         return jsonify({'items': []})
-    return jsonify(data)
+    return _registry_response(proto_type, entry)
 
 @app.route('/proto_detail/<proto_id>', methods=['GET'])
 def get_proto_detail(proto_id):
@@ -269,12 +303,9 @@ def get_proto_detail(proto_id):
         except Exception:
             return jsonify({})
 
-    for proto_type in ('morpho', 'chan', 'chem'):
-        data = _load_registry(proto_type)
-        if data:
-            for item in data.get('items', []):
-                if item.get('id') == proto_id:
-                    return jsonify(item.get('details', {}))
+    item = _find_registry_item(proto_id)
+    if item is not None:
+        return jsonify(item.get('details', {}))
     return jsonify({'error': 'Not found'}), 404
 
 @app.route('/proto_search/<proto_type>', methods=['GET'])
@@ -292,13 +323,13 @@ def search_protos(proto_type):
         except Exception as e:
             return jsonify({'error': str(e), 'items': []}), 500
 
-    data = _load_registry(proto_type)
-    if data is None:
+    entry = _load_registry(proto_type)
+    if entry is None:
         return jsonify({'items': []})
     if not q:
-        return jsonify(data)
+        return _registry_response(proto_type, entry)
     filtered = [
-        item for item in data.get('items', [])
+        item for item in entry[1].get('items', [])
         if q in item.get('name', '').lower()
         or q in item.get('description', '').lower()
         or q in item.get('source', '').lower()
@@ -313,7 +344,8 @@ def stage_proto_file(proto_id, client_id):
 
     if proto_id.startswith('nm_'):
         try:
-            return jsonify(_nm_stage(int(proto_id[3:]), client_id))
+            refresh = request.args.get('refresh') == '1'
+            return jsonify(_nm_stage(int(proto_id[3:]), client_id, refresh=refresh))
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
@@ -323,28 +355,25 @@ def stage_proto_file(proto_id, client_id):
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
-    for proto_type in ('morpho', 'chan', 'chem'):
-        data = _load_registry(proto_type)
-        if data:
-            for item in data.get('items', []):
-                if item.get('id') == proto_id:
-                    server_file = item.get('server_file', '')
-                    if not server_file:
-                        return jsonify({'error': 'No server file for this proto'}), 400
-                    # Security: only allow files from known safe subdirectories.
-                    parts = server_file.replace('\\', '/').split('/')
-                    if len(parts) < 2 or parts[0] not in _ALLOWED_STAGING_DIRS or '..' in parts:
-                        return jsonify({'error': 'Invalid server file path'}), 400
-                    src = os.path.join(BASE_DIR, server_file)
-                    if not os.path.exists(src):
-                        return jsonify({'error': 'File not found on server'}), 404
-                    dest_dir = os.path.join(USER_UPLOADS_DIR, client_id)
-                    os.makedirs(dest_dir, exist_ok=True)
-                    filename = os.path.basename(src)
-                    dest = os.path.join(dest_dir, filename)
-                    shutil.copy2(src, dest)
-                    return jsonify({'filename': filename})
-    return jsonify({'error': 'Proto not found'}), 404
+    item = _find_registry_item(proto_id)
+    if item is None:
+        return jsonify({'error': 'Proto not found'}), 404
+    server_file = item.get('server_file', '')
+    if not server_file:
+        return jsonify({'error': 'No server file for this proto'}), 400
+    # Security: only allow files from known safe subdirectories.
+    parts = server_file.replace('\\', '/').split('/')
+    if len(parts) < 2 or parts[0] not in _ALLOWED_STAGING_DIRS or '..' in parts:
+        return jsonify({'error': 'Invalid server file path'}), 400
+    src = os.path.join(BASE_DIR, server_file)
+    if not os.path.exists(src):
+        return jsonify({'error': 'File not found on server'}), 404
+    dest_dir = os.path.join(USER_UPLOADS_DIR, client_id)
+    os.makedirs(dest_dir, exist_ok=True)
+    filename = os.path.basename(src)
+    dest = os.path.join(dest_dir, filename)
+    shutil.copy2(src, dest)
+    return jsonify({'filename': filename})
 
 
 @app.route('/launch_simulation', methods=['POST'])
@@ -383,18 +412,21 @@ def launch_simulation():
 
     # Check for missing external files before launching (skip if frontend already warned the user)
     if not request_data.get('skip_missing_files_check'):
+        # One directory read instead of a stat per referenced file.
+        with os.scandir(session_dir) as it:
+            present = {e.name for e in it if e.is_file()}
         missing = []
         cell = config_data.get('cellProto', {})
         if isinstance(cell, dict) and cell.get('type') == 'file' and cell.get('source'):
-            if not os.path.isfile(os.path.join(session_dir, os.path.basename(cell['source']))):
+            if os.path.basename(cell['source']) not in present:
                 missing.append(cell['source'])
         for cp in config_data.get('chemProto', []):
             if cp.get('type') in ('sbml', 'SBML', 'kkit') and cp.get('source'):
-                if not os.path.isfile(os.path.join(session_dir, os.path.basename(cp['source']))):
+                if os.path.basename(cp['source']) not in present:
                     missing.append(cp['source'])
         for cp in config_data.get('chanProto', []):
             if cp.get('type') == 'neuroml' and cp.get('source'):
-                if not os.path.isfile(os.path.join(session_dir, os.path.basename(cp['source']))):
+                if os.path.basename(cp['source']) not in present:
                     missing.append(cp['source'])
         if missing:
             return jsonify({
@@ -490,9 +522,10 @@ def download_project(client_id):
     @after_this_request
     def remove_file(response):
         try:
-            if os.path.exists(archive_path):
-                os.remove(archive_path)
-                print(f"Deleted temp zip: {archive_path}")
+            os.remove(archive_path)
+            log.debug("Deleted temp zip: %s", archive_path)
+        except FileNotFoundError:
+            pass
         except Exception as e:
             print(f"Error removing temp zip: {e}")
         return response
@@ -500,28 +533,52 @@ def download_project(client_id):
     return send_file(archive_path, as_attachment=True, download_name="project.jardes")
 
 
+# Session dirs also hold simulation output (plot.json etc.) that can run to
+# many MB. Above this size, scan for the filetype marker via mmap before
+# reading and parsing the file.
+_MMAP_SCAN_THRESHOLD = 256 * 1024
+
+
+def _read_json_candidate(fpath, size):
+    """Return the raw bytes of fpath, or None if it is too large to be a model
+    and does not mention the jardesigner filetype."""
+    with open(fpath, 'rb') as f:
+        if size <= _MMAP_SCAN_THRESHOLD:
+            return f.read()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm.find(b'"jardesigner"') < 0:
+                return None
+            return mm[:]
+
+
 def _get_newest_jardesigner_json(session_dir):
     """Return (path, parsed_dict) of the newest jardesigner JSON, or (None, None).
     Sorts by trailing numeric index in the filename (highest wins), then mtime as tiebreaker.
     This is reliable even after ZIP extraction where all mtimes become identical."""
-    candidates = []
-    for fname in os.listdir(session_dir):
-        if not fname.endswith('.json'):
-            continue
-        fpath = os.path.join(session_dir, fname)
-        try:
-            with open(fpath, 'r') as f:
-                parsed = json.load(f)
-            if parsed.get('filetype') == 'jardesigner':
-                m = re.search(r'(\d+)\.json$', fname)
-                index = int(m.group(1)) if m else -1
-                candidates.append((index, os.path.getmtime(fpath), fpath, parsed))
-        except Exception:
-            continue
-    if not candidates:
-        return None, None
-    candidates.sort(reverse=True)
-    return candidates[0][2], candidates[0][3]
+    # Only the best candidate so far is kept, so earlier parsed models can be
+    # freed as soon as a newer one is found.
+    best_key, best_path, best_parsed = None, None, None
+    with os.scandir(session_dir) as it:
+        for entry in it:
+            if not entry.name.endswith('.json') or not entry.is_file():
+                continue
+            fname, fpath = entry.name, entry.path
+            try:
+                st = entry.stat()
+                raw = _read_json_candidate(fpath, st.st_size)
+                if raw is None:
+                    continue
+                parsed = json.loads(raw)
+                del raw
+                if parsed.get('filetype') == 'jardesigner':
+                    m = _JSON_INDEX_RE.search(fname)
+                    index = int(m.group(1)) if m else -1
+                    key = (index, st.st_mtime, fpath)
+                    if best_key is None or key > best_key:
+                        best_key, best_path, best_parsed = key, fpath, parsed
+            except Exception:
+                continue
+    return best_path, best_parsed
 
 
 def _get_referenced_sources(parsed):
@@ -549,7 +606,7 @@ def download_project_smart(client_id):
 
     basename = request.args.get('basename', 'model')
     # Sanitise: strip path separators and keep only safe characters
-    basename = re.sub(r'[^\w\-. ]', '_', os.path.basename(basename))
+    basename = _UNSAFE_BASENAME_RE.sub('_', os.path.basename(basename))
     if not basename:
         basename = 'model'
 
@@ -577,8 +634,9 @@ def download_project_smart(client_id):
     @after_this_request
     def remove_file(response):
         try:
-            if os.path.exists(tmp_zip_path):
-                os.remove(tmp_zip_path)
+            os.remove(tmp_zip_path)
+        except FileNotFoundError:
+            pass
         except Exception as ex:
             print(f"Error removing temp zip: {ex}")
         return response
@@ -645,8 +703,8 @@ def list_examples():
     index_path = os.path.join(EXAMPLES_DIR, 'index.json')
     if not os.path.isfile(index_path):
         return jsonify([])
-    with open(index_path, 'r') as f:
-        return jsonify(json.load(f))
+    with open(index_path, 'rb') as f:
+        return jsonify(json.loads(f.read()))
 
 
 @app.route('/load_example/<client_id>/<name>', methods=['POST'])
@@ -740,11 +798,12 @@ def handle_disconnect():
             # This socket is still the registered owner — safe to clean up.
             client_owner_map.pop(client_id, None)
             session_dir = os.path.join(USER_UPLOADS_DIR, client_id)
-            if os.path.exists(session_dir):
-                try:
-                    shutil.rmtree(session_dir)
-                except Exception as e:
-                    print(f"Error deleting session directory {session_dir}: {e}")
+            try:
+                shutil.rmtree(session_dir)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"Error deleting session directory {session_dir}: {e}")
         pid = client_sim_map.pop(client_id, None)
         if pid:
             terminate_process(pid)
@@ -764,15 +823,16 @@ def simulation_status(pid):
     proc_info = running_processes[pid]
     process = proc_info["process"]
     plot_filename = proc_info["plot_filename"]
-    client_id = proc_info["client_id"]
-    session_dir = os.path.join(USER_UPLOADS_DIR, client_id)
-    plot_filepath = os.path.abspath(os.path.join(session_dir, plot_filename))
 
     poll_result = process.poll()
     if poll_result is None:
         return jsonify({"status": "running", "pid": pid, "message": "Simulation is still in progress."}), 200
     else:
-        plot_exists = os.path.exists(plot_filepath)
+        # The plot can't change once the process has exited; stat it once.
+        plot_exists = proc_info.get("plot_ready")
+        if plot_exists is None:
+            plot_filepath = os.path.join(USER_UPLOADS_DIR, proc_info["client_id"], plot_filename)
+            plot_exists = proc_info["plot_ready"] = os.path.exists(plot_filepath)
         if plot_exists:
             return jsonify({"status": "completed", "pid": pid, "plot_filename": plot_filename, "plot_ready": True}), 200
         else: